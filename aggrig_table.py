@@ -5,25 +5,51 @@ import dash_bootstrap_components as dbc
 import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
+import os
+import warnings
 from cmo_function import *
 
 
 pd.set_option('future.no_silent_downcasting', True)
 
-# List of commodities indexed by group
-Indices = ['Energy', 'Beverages', 'Oils and Meals', 'Grains', 'Other Food', 'Timber', 'Other Raw Materials', 'Fertilizers', 'Metals and Minerals', 'Precious Metals']
+# List of commodities by group (names as in the source file after cleaning)
+commodity_group_members = {
+    'Energy': ['Crude oil, average', 'Crude oil, Brent', 'Crude oil, Dubai', 'Crude oil, WTI', 
+               'Coal, Australian', 'Coal, South African', 'Natural gas, US', 'Natural gas, Europe', 
+               'Liquefied natural gas, Japan', 'Natural gas index'],
+    'Beverages': ['Cocoa', 'Coffee, Arabica', 'Coffee, Robusta', 'Tea, avg 3 auctions', 
+                  'Tea, Colombo', 'Tea, Kolkata', 'Tea, Mombasa'],
+    'Oils and Meals': ['Coconut oil', 'Groundnuts', 'Fish meal', 'Groundnut oil', 'Palm oil', 
+                       'Palm kernel oil', 'Soybeans', 'Soybean oil', 'Soybean meal', 
+                       'Rapeseed oil', 'Sunflower oil'],
+    'Grains': ['Barley', 'Maize', 'Sorghum', 'Rice, Thai 5%', 'Rice, Thai 25%', 'Rice, Thai A1', 
+               'Rice, Viet Namese 5%', 'Wheat, US SRW', 'Wheat, US HRW'],
+    'Other Food': ['Banana, Europe', 'Banana, US', 'Orange', 'Beef', 'Chicken', 'Lamb', 
+                   'Shrimps, Mexican', 'Sugar, EU', 'Sugar, US', 'Sugar, world', 'Tobacco, US import uv'],
+    'Timber': ['Logs, Cameroon', 'Logs, Malaysian', 'Sawnwood, Cameroon', 'Sawnwood, Malaysian', 'Plywood'],
+    'Other Raw Materials': ['Cotton, A Index', 'Rubber, TSR20', 'Rubber, RSS3'],
+    'Fertilizers': ['Phosphate rock', 'DAP', 'TSP', 'Urea', 'Potassium chloride'],
+    'Metals and Minerals': ['Aluminum', 'Iron ore, cfr spot', 'Copper', 'Lead', 'Tin', 'Nickel', 'Zinc'],
+    'Precious Metals': ['Gold', 'Platinum', 'Silver'],
+}
+# Map each commodity name to its group
+group_by_name = {commodity: index for index, commodities in commodity_group_members.items() for commodity in commodities}
+
+# Series removed by hand before the validation stage (to check the automatic exclusion)
+expected_excluded = ['Barley', 'Sorghum', 'Shrimps, Mexican', 'Phosphate rock']
 
 # Define url for data
 url = "https://raw.githubusercontent.com/plotly/Figure-Friday/refs/heads/main/2024/week-50/CMO-Historical-Data-Monthly.csv"
+# Define first year of the analysis period
+start_year = 2010
+# Define path for data validation report (written only if CMO_VALIDATION_REPORT is set)
+report_path = os.environ.get('CMO_VALIDATION_REPORT')
 
 
 #Data preprocessing================================================================
-def read_and_clean_data(url):
+def read_and_clean_data(url, group_by_name, start_year=2010, max_missing_share=0.1, max_stale_tail=6, report_path=None):
     # Read data
     data = pd.read_csv(url)
-    # Remove a few columns with empty values
-    removelist = ['Barley', 'Sorghum', 'Shrimps, Mexican', 'Phosphate rock']
-    data = data.drop(removelist, errors = 'ignore', axis = 1)
     # Remove special character from column names    
     data.columns = [col.strip(' **').replace('.', '') for col in data.columns]
 
@@ -38,14 +64,36 @@ def read_and_clean_data(url):
     
     # Drop first two rows
     df = data.drop([0, 1])  
-   
-    # Convert all values to numeric in columns starting from the second one
-    for col in df.columns[1:]:
-        df[col] = pd.to_numeric(df[col], errors='coerce').ffill()
 
     # Rename first column and convert to datetime
     df = df.rename(columns={'Unnamed: 0': 'Date'})
     df['Date'] = pd.to_datetime(df['Date'], format='%YM%m')
+
+    # Convert all values to numeric in columns starting from the second one (in one pass)
+    commodity_cols = df.columns[1:].tolist()
+    raw_values = df[commodity_cols].to_numpy(dtype=object)
+    values = pd.to_numeric(raw_values.ravel(), errors='coerce').astype(float).reshape(raw_values.shape)
+
+    # Validate data for selected years and write report
+    in_period = (df['Date'].dt.year >= start_year).to_numpy()
+    report = validate_commodity_data(raw_values, values, commodity_cols, unit, group_by_name, in_period, 
+                                     max_missing_share, max_stale_tail)
+    if report_path:
+        # Don't stop the app if the report can't be written (e.g. read-only file system)
+        try:
+            report.to_csv(report_path, index=False)
+        except OSError as e:
+            warnings.warn(f'Could not write validation report to {report_path}: {e}')
+
+    # Fill gaps with previous values 
+    df[commodity_cols] = pd.DataFrame(values, index=df.index, columns=commodity_cols).ffill()
+
+    # Remove columns with too many missing values or without recent values
+    removelist = report.loc[report['Excluded'], 'Product'].tolist()
+    df = df.drop(removelist, axis = 1)
+    for col in removelist:
+        unit.pop(col)
+
     # Add year and formatted month columns 
     df['month_3'] = df['Date'].dt.strftime('%b')
     df['year'] = df['Date'].dt.year
@@ -54,39 +102,39 @@ def read_and_clean_data(url):
     df['month_3'] = df['month_3'].astype("category").cat.set_categories(month_order_list, ordered=True) 
 
     # Filter data by selected years (2010-2024)
-    df = df[df['year'] >= 2010].reset_index(drop=True)
+    df = df[df['year'] >= start_year].reset_index(drop=True)
    
-    return df, unit
+    return df, unit, report
 
-# Get data and unit
-df_2010_2024, unit = read_and_clean_data(url)
+# Get data, unit and validation report
+df_2010_2024, unit, validation_report = read_and_clean_data(url, group_by_name, start_year, report_path=report_path)
 df_for_table = df_2010_2024.iloc[-13:, :-2].copy()
 
+# Check that the automatic exclusion removes the same series as the previous hardcoded list
+excluded = validation_report.loc[validation_report['Excluded'], 'Product'].tolist()
+if set(excluded) != set(expected_excluded):
+    warnings.warn(f'Excluded series {sorted(excluded)} differ from expected {sorted(expected_excluded)}')
+
+# Get commodities priced in cents while their group is priced in dollars (e.g. Plywood)
+cents_commodities = validation_report.loc[validation_report['Currency mismatch'] & 
+                                          (validation_report['Currency'] == '¢'), 'Product'].tolist()
 
-def get_commodity_group(dff, indices):
-    # Get commodity groups for each index    
-    energy_cols = dff.columns[1:11].tolist()
-    beverages_cols = dff.columns[11:18].tolist()
-    oils_meals = dff.columns[18:29].tolist()
-    grains = dff.columns[29:36].tolist()
-    other_food = dff.columns[36:46].tolist()
-    timber_cols = dff.columns[46:51].tolist()
-    other_raw_cols = dff.columns[51:54].tolist()
-    fertilizers_cols = dff.columns[54:58].tolist()
-    metals_cols = dff.columns[58:65].tolist()
-    precious_metals_cols = dff.columns[65:68].tolist()
-    # Create a list of all groups
-    all_groups = [energy_cols, beverages_cols, oils_meals, grains, other_food, timber_cols, 
-                  other_raw_cols, fertilizers_cols, metals_cols, precious_metals_cols]
-    # Create a dictionary with index as key and group as value
+
+def get_commodity_group(dff, group_members):
+    # Get commodity groups for each index (without excluded commodities)
     commodity_groups = {}
-    for i, g in zip(indices, all_groups):
-        commodity_groups[i] = g
+    for i, commodities in group_members.items():
+        commodity_groups[i] = [col for col in commodities if col in dff.columns]
+    # Check that each commodity in data belongs to a group
+    grouped = [col for commodities in commodity_groups.values() for col in commodities]
+    ungrouped = [col for col in dff.columns[1:-2] if col not in grouped]
+    if ungrouped:
+        warnings.warn(f'Commodities without a group: {ungrouped}')
 
     return commodity_groups
 
 # Get commodity groups
-commodity_groups = get_commodity_group(df_2010_2024, Indices)
+commodity_groups = get_commodity_group(df_2010_2024, commodity_group_members)
 
 
 def melt_data(dff):  
@@ -116,6 +164,13 @@ df_melt  = melt_data(df_for_table)
 
 # Get datafreame with graph for ag-grid table
 dfgrid = create_sparkline(df_melt)
+
+# Get MoM/YoY z-scores and percentile ranks for all commodities and months
+commodity_cols = df_2010_2024.columns[1:-2].tolist()
+df_anomaly = compute_anomaly_scores(df_2010_2024, 'Date', commodity_cols)
+# Add anomaly columns for the last month to ag-grid table
+dfgrid = dfgrid.merge(df_anomaly, on=['Date', 'Product'], how='left')
+
 # Add column with unit of measurement
 dfgrid['Unit'] = dfgrid['Product'].map(unit)   
 
@@ -134,6 +189,7 @@ maxmonth = dfgrid['Date'].max()
 lastmonth_label = maxmonth.strftime('%b %Y')
 prevmonth_label = (maxmonth + pd.DateOffset(months=-1)).strftime('%b %Y')
 prevyear_label = (maxmonth + pd.DateOffset(years=-1)).strftime('%b %Y')
+firstyear_label = df_2010_2024['Date'].min().strftime('%Y')
 
 # Conditional formatting
 sellstyle_condition = {   
@@ -198,6 +254,26 @@ columnDefs = [
          "filter": False, 'sortable': False,
          "maxWidth": 300,
          "minWidth": 200}
+    ]},
+
+    # Header with subheaders for extreme moves
+    {'headerName': 'Anomaly', 
+     "children": [
+        {"headerName": "Score",
+         "field": "Anomaly score", "minWidth": 90,
+         'headerTooltip': f"Max absolute z-score of MoM and YoY change vs history since {firstyear_label}",
+         # Show a dash instead of formatting missing values as zero
+         "tooltipValueGetter": {
+            "function": "'MoM z = ' + (params.data['MoM z'] == null ? '–' : d3.format('.2f')(params.data['MoM z'])) \
+                + ' (pct rank ' + (params.data['MoM pct rank'] == null ? '–' : d3.format('.0%')(params.data['MoM pct rank'])) \
+                + '), YoY z = ' + (params.data['YoY z'] == null ? '–' : d3.format('.2f')(params.data['YoY z'])) \
+                + ' (pct rank ' + (params.data['YoY pct rank'] == null ? '–' : d3.format('.0%')(params.data['YoY pct rank'])) + ')'"},
+         "valueFormatter": {"function": "params.value == null ? '–' : d3.format('.2f')(params.value)"}},
+        {"headerName": "Outlier",
+         "field": "Outlier", "minWidth": 100,
+         'headerTooltip': "Commodities with extreme MoM or YoY moves",
+         "filter": "agTextColumnFilter",
+         'cellStyle': {"color": "crimson"}}
     ]}
 ]
 
@@ -327,6 +403,7 @@ app.layout = dbc.Container([
                 aggrid_table, 
                 html.Div([
                     dropdown_abreviations,
+                    dbc.Button('Show Outliers', id='show-outliers-button', n_clicks=0, class_name='btn-secondary'),
                     dbc.Button('Reset Table Filters', id='reset-filters-button', n_clicks=0, class_name='btn-secondary'),
                     dbc.Button('Download CSV', id='download-button', n_clicks=0, class_name='btn-secondary'), 
                     ], className='d-flex justify-content-between align-items-center'),                    
@@ -361,8 +438,8 @@ def display_modal(selected_cell, is_open):
             fig = create_area_fillgradient(dff, 'Date', product, col_scale, line_color, title)
             fig.update_traces(hovertemplate='%{x}<br>Price = $%{y:,.2f}') 
             fig.update_layout(paper_bgcolor='white', plot_bgcolor='white', height=350) 
-            # Update properties for Plywood Commodity
-            if product == 'Plywood':
+            # Update properties for commodities priced in cents (e.g. Plywood)
+            if product in cents_commodities:
                 fig.update_layout(yaxis_ticksuffix='¢') 
                 fig.update_traces(hovertemplate='%{x}<br>Price = ¢%{y:,.2f}')  
             
@@ -397,6 +474,19 @@ def reset_all_filters(n_clicks):
     return no_update, no_update
 
 
+# Callback to filter table by commodities with extreme moves
+@app.callback(
+    Output('ag-grid-with-graph', 'filterModel', allow_duplicate=True),
+    Input('show-outliers-button', 'n_clicks'),
+    prevent_initial_call=True
+)
+def show_outliers(n_clicks):
+    if n_clicks:
+        # Keep only rows flagged as outliers
+        return {'Outlier': {'filterType': 'text', 'type': 'notBlank'}}
+    return no_update
+
+
 # Callback to download the data as csv file
 @app.callback(
     Output("ag-grid-with-graph", "exportDataAsCsv"),
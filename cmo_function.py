@@ -1,3 +1,6 @@
+import hashlib
+import warnings
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 
@@ -210,7 +213,7 @@ def line_chart_with_pos_and_neg_colors(dff, x_col_name, y_col_name,
 
     # Create a list of colors for each data point based on its sign
     # If the value is positive or zero, use 'pos_color', otherwise use 'neg_col'
-    marker_colors = [pos_color if v > 0 else neg_col if v < 0 else 'lightgrey' for v in y]  
+    marker_colors = np.select([y > 0, y < 0], [pos_color, neg_col], default='lightgrey').tolist()  
 
     # Generate a colorscale that transitions between neg_col and pos_color at zero    
     colorscale = colorscale_with_zero_position(y, neg_col, pos_color)  
@@ -249,3 +252,121 @@ def line_chart_with_pos_and_neg_colors(dff, x_col_name, y_col_name,
     )
    
     return fig
+
+#===============================================================================
+# Cache of anomaly scores for the latest data version (hash of the price panel)
+anomaly_cache = {}
+
+def pct_change_panel(prices, periods):
+    # Calculate the percentage change for all columns at once
+    change = np.full(prices.shape, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change[periods:] = prices[periods:] / prices[:-periods] - 1
+    # Replace division by zero results with NaN
+    change[~np.isfinite(change)] = np.nan
+    return change
+
+def zscore_panel(change):
+    # Calculate z-score for each column, ignoring NaN values
+    # (columns without values get NaN without warnings about empty slices)
+    with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'):
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        mean = np.nanmean(change, axis=0)
+        std = np.nanstd(change, axis=0)
+        z = (change - mean) / np.where(std > 0, std, np.nan)
+    return z
+
+def percentile_rank_panel(change):
+    # Rank values within each column (ties get average rank, NaN values are kept)
+    return pd.DataFrame(change).rank(pct=True).to_numpy()
+
+def compute_anomaly_scores(dff, date_col, value_cols, z_threshold=2.5):
+    # Use hash of the ordered price panel as data version
+    row_hashes = pd.util.hash_pandas_object(dff[[date_col] + value_cols], index=False).to_numpy()
+    version = (hashlib.sha1(row_hashes).hexdigest(), date_col, tuple(value_cols), z_threshold)
+    if version in anomaly_cache:
+        # Return a copy so that callers can't modify the cached data
+        return anomaly_cache[version].copy()
+
+    # Convert price panel to 2D array (months x commodities)
+    prices = dff[value_cols].to_numpy(dtype=float)
+    mom = pct_change_panel(prices, 1)
+    yoy = pct_change_panel(prices, 12)
+    mom_z, yoy_z = zscore_panel(mom), zscore_panel(yoy)
+
+    # Flag extreme moves where absolute z-score exceeds the threshold
+    mom_flag = np.abs(np.nan_to_num(mom_z)) >= z_threshold
+    yoy_flag = np.abs(np.nan_to_num(yoy_z)) >= z_threshold
+    flag = np.full(prices.shape, None, dtype=object)
+    flag[yoy_flag] = 'YoY'
+    flag[mom_flag] = 'MoM'
+    flag[mom_flag & yoy_flag] = 'MoM & YoY'
+
+    # Reshape results to long format (one row per commodity and month)
+    n_dates, n_cols = prices.shape
+    df_anomaly = pd.DataFrame({
+        date_col: np.repeat(dff[date_col].to_numpy(), n_cols),
+        'Product': np.tile(np.asarray(value_cols, dtype=object), n_dates),
+        'MoM z': mom_z.ravel(),
+        'YoY z': yoy_z.ravel(),
+        'MoM pct rank': percentile_rank_panel(mom).ravel(),
+        'YoY pct rank': percentile_rank_panel(yoy).ravel(),
+        'Anomaly score': np.fmax(np.abs(mom_z), np.abs(yoy_z)).ravel(),
+        'Outlier': flag.ravel()})
+
+    # Keep only the latest data version in cache
+    anomaly_cache.clear()
+    anomaly_cache[version] = df_anomaly
+    return df_anomaly.copy()
+
+#===============================================================================
+def validate_commodity_data(raw_values, values, products, unit, group_by_name, in_period, 
+                            max_missing_share=0.1, max_stale_tail=6):
+    # Use 2D arrays (months x commodities) for the full history, 
+    # since forward fill uses values before the selected period
+    is_nan = np.isnan(values)
+    n_dates = values.shape[0]
+    row_idx = np.arange(n_dates)[:, None]
+
+    # Find first and last valid value for each commodity (n_dates if no valid values)
+    has_value = (~is_nan).any(axis=0)
+    first_valid = np.where(has_value, np.argmax(~is_nan, axis=0), n_dates)
+    stale_tail = np.where(has_value, np.argmax(~is_nan[::-1], axis=0), n_dates)
+
+    # NaN values after the first valid value are forward-filled
+    is_filled = is_nan & (row_idx >= first_valid)
+
+    # Keep only months of the selected period
+    raw_missing = pd.isna(raw_values[in_period])
+    is_nan, is_filled = is_nan[in_period], is_filled[in_period]
+
+    # Calculate length of consecutive filled values within the period (reset on each valid value)
+    run_total = np.cumsum(is_filled, axis=0)
+    run_start = np.maximum.accumulate(np.where(is_filled, 0, run_total), axis=0)
+    longest_gap = (run_total - run_start).max(axis=0, initial=0)
+
+    # Compare currency of each commodity (e.g. $ in $/mt) with the most common one in its group
+    units = pd.Series(products, dtype=object).map(unit)
+    groups = pd.Series(products, dtype=object).map(group_by_name)
+    currency = units.str.split('/').str[0]
+    group_currency = currency.groupby(groups).transform(lambda s: s.mode().iat[0])
+    currency_mismatch = (currency != group_currency) & groups.notna()
+
+    # Create report with one row per commodity
+    report = pd.DataFrame({
+        'Product': products,
+        'Group': groups,
+        'Unit': units,
+        'Currency': currency,
+        'NaN count': is_nan.sum(axis=0),
+        'Coerced count': (is_nan & ~raw_missing).sum(axis=0),
+        'Filled count': is_filled.sum(axis=0),
+        'Longest gap': longest_gap,
+        'Stale tail': stale_tail,
+        'Missing share': is_nan.mean(axis=0),
+        'Currency mismatch': currency_mismatch})
+    # Exclude commodities with too many missing values or without recent values
+    report['Excluded'] = ((report['Missing share'] > max_missing_share) | 
+                          (report['Stale tail'] > max_stale_tail))
+
+    return report